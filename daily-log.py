@@ -7,21 +7,30 @@
 #     • whether the CSV was found (and its path)
 #     • the latest date detected in the CSV
 #     • which dates were checked and how many rows were parsed/kept
+# - With --rebuild, rewrites CSV and JSON in full from the CSV (no fetching)
 #
 # Requirements:
-#   pip install requests pdfplumber
+#   pip install requests pdfplumber orjson
 
+import argparse
 import csv
 import io
-import json
+import multiprocessing
+import os
 import re
+import shutil
 from datetime import datetime, timedelta, date
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
 from typing import List, Tuple, Optional
 
+import orjson
 import requests
-import pdfplumber
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --------------------------------------------------------------------
 # Configuration (point explicitly to root-level files)
@@ -30,10 +39,15 @@ BASE_DIR = Path(__file__).resolve().parent
 CSV_FILE = BASE_DIR / "usc_crime_logs.csv"
 JSON_FILE = BASE_DIR / "usc_crime_logs.json"
 
+# Buffer size for archive reads/writes: a few large syscalls instead of many
+# small ones as the CSV grows.
+IO_BUFFER = 1 << 20
+
 # If no CSV exists yet, earliest date to backfill from:
 EARLIEST_DATE = date(2023, 12, 4)
 
-BASE_URL = "https://dps.usc.edu/wp-content/uploads/{year}/{month:02d}/{mmddyy}.pdf"
+# Daily PDFs live at {BASE_URL}/{year}/{month:02d}/{mmddyy}.pdf
+BASE_URL = "https://dps.usc.edu/wp-content/uploads"
 
 HEADERS = [
     "Date Reported", "Event #", "Case #",
@@ -42,6 +56,28 @@ HEADERS = [
     "URL"
 ]
 
+# Shared HTTP session: worker threads reuse keep-alive connections to dps.usc.edu
+# instead of paying a TCP/TLS handshake per day. Pool size covers the worker count.
+HTTP_POOL_SIZE = 24
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=HTTP_POOL_SIZE,
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(total=3, backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+PDF_MAGIC = b"%PDF-"
+
+# The DPS log is a fully ruled table, so cells come straight from the drawn
+# lines; built once rather than per page.
+TABLE_SETTINGS = {
+    "vertical_strategy": "lines",
+    "horizontal_strategy": "lines",
+}
+
+_EMPTY_PAD = [""] * len(HEADERS)
+
 # Column indexes for convenience
 IDX_DATE_REPORTED = 0
 IDX_EVENT = 1
@@ -53,26 +89,29 @@ IDX_DATE_TO = 7
 # --------------------------------------------------------------------
 
 DATE_RE = re.compile(r'(\d{1,2}/\d{1,2}/\d{2,4})')
+# Anchored variant for cells that start with the date (the common case);
+# its groups feed date() directly, so no strptime per row.
+_DATE_FAST = re.compile(r'^\s*(\d{1,2})/(\d{1,2})/(\d{2,4})')
 
 def parse_mmddyy_or_yyyy(s: str) -> Optional[date]:
     """Parse MM/DD/YY or MM/DD/YYYY; return None on failure."""
-    s = (s or "").strip()
-    for fmt in ("%m/%d/%y", "%m/%d/%Y"):
-        try:
-            return datetime.strptime(s, fmt).date()
-        except ValueError:
-            pass
-    # Lenient fallback via regex capture
-    m = DATE_RE.search(s)
-    if m:
-        mm, dd, yyyy = m.group(1).split("/")
-        if len(yyyy) == 2:
-            yyyy = str(2000 + int(yyyy))
-        try:
-            return date(int(yyyy), int(mm), int(dd))
-        except Exception:
-            return None
-    return None
+    m = _DATE_FAST.match(s or "")
+    if not m:
+        return None
+    y = int(m[3])
+    if y < 100:
+        y += 2000
+    try:
+        return date(y, int(m[1]), int(m[2]))
+    except ValueError:
+        return None
+
+# Memoized on the extracted "MM/DD/YY" text rather than on whole cells: cells
+# carry times ("... at 22:13") and are nearly all distinct, while the archive
+# spans only a few hundred distinct dates. This only serves best_row_date,
+# i.e. scan_existing's fallback when no Date Reported parses at all; a normal
+# run never reaches it.
+_parse_date_text = lru_cache(maxsize=4096)(parse_mmddyy_or_yyyy)
 
 def parse_any_date_field(s: str) -> Optional[date]:
     """Extract a date even if extra text/time is present (e.g., '09/05/2024 00:00')."""
@@ -81,7 +120,7 @@ def parse_any_date_field(s: str) -> Optional[date]:
     m = DATE_RE.search(s)
     if not m:
         return None
-    return parse_mmddyy_or_yyyy(m.group(1))
+    return _parse_date_text(m.group(1))
 
 def best_row_date(row: List[str]) -> Optional[date]:
     """
@@ -97,49 +136,58 @@ def best_row_date(row: List[str]) -> Optional[date]:
                 return d
     return None
 
-def load_existing_csv() -> Tuple[List[List[str]], set, Optional[date]]:
+def scan_existing() -> Tuple[set, Optional[date]]:
     """
-    Load existing rows from CSV_FILE.
+    Stream CSV_FILE once, keeping only what the incremental run needs.
     Returns:
-      - rows: list of row lists (without header)
       - event_ids: set of existing Event # values (non-empty only)
-      - latest_date: max date found among Date Reported / From / To
+      - latest_date: max Date Reported (falls back to Date From / To)
+    Rows are not kept; see load_existing_csv for the full archive.
     """
-    if not CSV_FILE.exists():
-        return [], set(), None
-
-    rows: List[List[str]] = []
     event_ids = set()
     latest: Optional[date] = None
+    if not CSV_FILE.exists():
+        return event_ids, latest
 
-    with CSV_FILE.open("r", encoding="utf-8", newline="") as f:
+    with CSV_FILE.open("r", encoding="utf-8", newline="", buffering=IO_BUFFER) as f:
         reader = csv.reader(f)
         _header = next(reader, None)  # skip header if present
         for row in reader:
             if not row:
                 continue
-            rows.append(row)
             if len(row) > IDX_EVENT and row[IDX_EVENT]:
                 event_ids.add(row[IDX_EVENT])
-            d = best_row_date(row)
+            # Date Reported starts with the date, so the anchored match is
+            # enough here; From/To are only consulted if it never parses.
+            d = parse_mmddyy_or_yyyy(row[IDX_DATE_REPORTED])
             if d and (latest is None or d > latest):
                 latest = d
 
-    return rows, event_ids, latest
+    if latest is None:
+        latest = max(filter(None, map(best_row_date, load_existing_csv())), default=None)
 
-def daterange(start: date, end: date):
-    """Inclusive generator from start to end (dates)."""
-    cur = start
-    while cur <= end:
-        yield cur
-        cur += timedelta(days=1)
+    return event_ids, latest
+
+def load_existing_csv() -> List[List[str]]:
+    """Load all existing rows from CSV_FILE (without header)."""
+    if not CSV_FILE.exists():
+        return []
+
+    with CSV_FILE.open("r", encoding="utf-8", newline="", buffering=IO_BUFFER) as f:
+        reader = csv.reader(f)
+        _header = next(reader, None)  # skip header if present
+        return [row for row in reader if row]
+
+def daterange(start: date, end: date) -> List[date]:
+    """Inclusive list of dates from start to end."""
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
 
 def normalize_row(cells: List[str], url: str) -> List[str]:
     """
     Ensure a row matches HEADERS length and is stripped of whitespace.
     Assumes the PDF table columns correspond 1:1 with HEADERS[:-1] (before URL).
     """
-    cleaned = [str(c or "").strip() for c in cells]
+    cleaned = [c.strip() if c else "" for c in cells]
     target = len(HEADERS) - 1
     if len(cleaned) > target:
         cleaned = cleaned[:target]
@@ -148,30 +196,58 @@ def normalize_row(cells: List[str], url: str) -> List[str]:
     cleaned.append(url)
     return cleaned
 
-def fetch_and_parse(d: date) -> Tuple[date, List[List[str]]]:
+@lru_cache(maxsize=None)
+def pdf_url(d: date) -> str:
+    """URL of the daily PDF for date d (hand-formatted; no str.format/strftime)."""
+    return f"{BASE_URL}/{d.year}/{d.month:02d}/{d.month:02d}{d.day:02d}{d.year % 100:02d}.pdf"
+
+def download_pdf(d: date) -> Tuple[date, Optional[bytes]]:
+    """
+    Download the daily PDF for date d.
+    Returns the raw bytes, or None if the day has no PDF (or the request failed).
     """
-    Fetch the daily PDF for date d and return parsed rows with URL appended.
+    try:
+        # Stream so missing days (404) and HTML error pages served with a 200
+        # are rejected from the headers alone, without reading the body.
+        with SESSION.get(pdf_url(d), timeout=20, stream=True) as r:
+            if r.status_code != 200:
+                return d, None
+            if r.headers.get("Content-Type", "").startswith("text/"):
+                return d, None
+            content = r.content
+        # Don't hand non-PDF bodies to pdfplumber; the header must appear
+        # within the first 1 KiB.
+        if PDF_MAGIC not in content[:1024]:
+            return d, None
+        return d, content
+    except Exception:
+        # Swallow exceptions per day to keep the run resilient
+        return d, None
+
+def parse_pdf(d: date, content: bytes) -> Tuple[date, List[List[str]]]:
+    """
+    Parse the PDF bytes for date d and return rows with URL appended.
     Uses line-based table extraction for stability.
+    Top-level (and free of shared state) so it can run in a worker process;
+    pdfplumber is imported here so only the workers pay for it.
     """
-    url = BASE_URL.format(year=d.year, month=d.month, mmddyy=d.strftime("%m%d%y"))
+    import pdfplumber
+
+    url = pdf_url(d)
     try:
-        r = requests.get(url, timeout=20)
-        if r.status_code != 200:
-            return d, []
-        with pdfplumber.open(io.BytesIO(r.content)) as pdf:
+        # laparams=None (pdfplumber's default, kept explicit): the lines
+        # strategy works from drawn rules and needs no pdfminer layout pass.
+        with pdfplumber.open(io.BytesIO(content), laparams=None) as pdf:
             out_rows: List[List[str]] = []
             for page in pdf.pages:
-                table = page.extract_table({
-                    "vertical_strategy": "lines",
-                    "horizontal_strategy": "lines"
-                })
+                table = page.extract_table(TABLE_SETTINGS)
+                page.close()  # drop this page's cached chars/edges before the next
                 if not table:
                     continue
-                # Skip header row if first row contains "Date Reported"
-                start_idx = 0
-                if table and table[0]:
-                    if any("Date Reported" in (cell or "") for cell in table[0]):
-                        start_idx = 1
+                # Skip header row; "Date Reported" is always its first cell.
+                # Checked per page since the header may repeat on each one.
+                first = table[0][0] if table[0] else None
+                start_idx = 1 if first and "Date Reported" in first else 0
                 for raw in table[start_idx:]:
                     if not raw:
                         continue
@@ -182,24 +258,74 @@ def fetch_and_parse(d: date) -> Tuple[date, List[List[str]]]:
         return d, []
 
 def write_csv(all_rows: List[List[str]]):
-    with CSV_FILE.open("w", newline="", encoding="utf-8") as f:
+    with CSV_FILE.open("w", newline="", encoding="utf-8", buffering=IO_BUFFER) as f:
         writer = csv.writer(f)
         writer.writerow(HEADERS)
         writer.writerows(all_rows)
 
+def rows_to_records(rows: List[List[str]]) -> List[dict]:
+    """Map each row onto HEADERS; short rows are padded with "" (zip stops at HEADERS)."""
+    return [dict(zip(HEADERS, chain(row, _EMPTY_PAD))) for row in rows]
+
+def write_atomic(path: Path, data: bytes):
+    """Write data via a temp file + os.replace, so path is never left half-written."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
 def write_json(all_rows: List[List[str]]):
-    data = [
-        {HEADERS[i]: (row[i] if i < len(row) else "") for i in range(len(HEADERS))}
-        for row in all_rows
-    ]
-    with JSON_FILE.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    data = rows_to_records(all_rows)
+    # Compact output via orjson: much faster than json.dump(indent=2) and a
+    # fraction of the size on disk.
+    write_atomic(JSON_FILE, orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
+
+def prepend_csv(new_rows: List[List[str]]):
+    """
+    Write new_rows to the top of CSV_FILE without parsing the archive:
+    header + new rows go to a temp file, then the old body is copied verbatim.
+    """
+    tmp = CSV_FILE.with_name(CSV_FILE.name + ".tmp")
+    with tmp.open("w", newline="", encoding="utf-8", buffering=IO_BUFFER) as out:
+        writer = csv.writer(out)
+        writer.writerow(HEADERS)
+        writer.writerows(new_rows)
+        with CSV_FILE.open("r", newline="", encoding="utf-8", buffering=IO_BUFFER) as old:
+            old.readline()  # drop the old header line
+            shutil.copyfileobj(old, out, IO_BUFFER)
+    os.replace(tmp, CSV_FILE)
+
+def prepend_json(new_rows: List[List[str]]) -> bool:
+    """
+    Splice new_rows into the front of the JSON array in JSON_FILE, serializing
+    only the new rows. Returns False (writing nothing) if the file is missing
+    or not an array, so the caller can rebuild it from the CSV instead.
+    The JSON is trusted to match the CSV: if the two ever drift (e.g. a run
+    dies between prepend_csv and this call), the gap persists until
+    --rebuild regenerates the JSON from the CSV.
+    """
+    if not new_rows:
+        return True
+    if not JSON_FILE.exists():
+        return False
+    old = JSON_FILE.read_bytes().lstrip()
+    if not old.startswith(b"["):
+        return False
+    rest = old[1:].lstrip()
+    data = rows_to_records(new_rows)
+    head = orjson.dumps(data)
+    if rest.startswith(b"]"):
+        write_atomic(JSON_FILE, head + b"\n")
+    else:
+        # head is "[...new...]"; drop its closing bracket and continue with
+        # the old elements (whatever their layout).
+        write_atomic(JSON_FILE, head[:-1] + b"," + rest)
+    return True
 
 # --------------------------------------------------------------------
 # Main incremental updater
 # --------------------------------------------------------------------
 
-def backfill_incremental(workers: int = 12):
+def backfill_incremental(workers: int = HTTP_POOL_SIZE):
     # Print whether CSV exists, and its path
     csv_exists = CSV_FILE.exists()
     print(f"CSV {'found' if csv_exists else 'NOT found'} at: {CSV_FILE.resolve()}")
@@ -209,8 +335,8 @@ def backfill_incremental(workers: int = 12):
         with CSV_FILE.open("w", newline="", encoding="utf-8") as f:
             csv.writer(f).writerow(HEADERS)
 
-    # Load archive and detect latest date + existing Event #s
-    existing_rows, existing_event_ids, latest_found = load_existing_csv()
+    # Scan archive for latest date + existing Event #s
+    existing_event_ids, latest_found = scan_existing()
     print(f"Latest date in CSV: {latest_found}")
 
     # Determine the first date to check
@@ -226,26 +352,46 @@ def backfill_incremental(workers: int = 12):
         return
 
     # Build list of days to check (inclusive)
-    dates = list(daterange(start_date, today))
+    dates = daterange(start_date, today)
     print(f"Checking PDFs from {start_date} through {today} "
           f"({len(dates)} day{'s' if len(dates) != 1 else ''})")
 
-    # Fetch PDFs in parallel (with simple debug per day)
-    all_new_rows: List[List[str]] = []
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = {executor.submit(fetch_and_parse, d): d for d in dates}
-        for future in as_completed(futures):
-            d = futures[future]
+    # Download PDFs on a thread pool (network-bound: threads release the GIL
+    # while waiting on the socket) and hand each one to a process pool for
+    # parsing as soon as it arrives (pdfplumber/pdfminer is pure-Python CPU
+    # work, so threads would serialize on the GIL). Worker processes are only
+    # started once there is a PDF to parse, which is while download threads
+    # are still running, so they are spawned rather than forked: forking a
+    # multi-threaded process can deadlock on locks held by those threads.
+    # (PDF date, row) pairs; the date is kept as the sort key below.
+    all_new_rows: List[Tuple[date, List[str]]] = []
+    with ThreadPoolExecutor(max_workers=workers) as io_pool, \
+            ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                mp_context=multiprocessing.get_context("spawn")) as cpu_pool:
+        parse_futures = {}
+        for future in as_completed([io_pool.submit(download_pdf, d) for d in dates]):
+            d, content = future.result()
+            if content:
+                try:
+                    parse_futures[cpu_pool.submit(parse_pdf, d, content)] = d
+                except Exception as e:
+                    # e.g. BrokenProcessPool after a worker crash; skip the day
+                    print(f"[{d}] ERROR during parse: {e}")
+            else:
+                print(f"[{d}] no PDF found.")
+
+        for future in as_completed(parse_futures):
+            d = parse_futures[future]
             try:
                 _d, rows = future.result()
             except Exception as e:
-                print(f"[{d}] ERROR during fetch/parse: {e}")
+                print(f"[{d}] ERROR during parse: {e}")
                 rows = []
             if rows:
                 print(f"[{d}] parsed {len(rows)} row(s).")
-                all_new_rows.extend(rows)
+                all_new_rows.extend((d, row) for row in rows)
             else:
-                print(f"[{d}] no PDF or no rows found.")
+                print(f"[{d}] no rows found.")
 
     if not all_new_rows:
         print("No new rows discovered across the checked dates.")
@@ -253,13 +399,13 @@ def backfill_incremental(workers: int = 12):
 
     # Include rows even if Event # is missing; dedupe only when Event # is present
     before_dedupe = len(all_new_rows)
-    unique_new_rows: List[List[str]] = []
+    unique_new_rows: List[Tuple[date, List[str]]] = []
     seen = set(existing_event_ids)  # existing non-empty Event #s
-    for row in all_new_rows:
+    for d, row in all_new_rows:
         ev = row[IDX_EVENT] if len(row) > IDX_EVENT else ""
         if ev and ev in seen:
             continue  # duplicate with a real Event # — skip
-        unique_new_rows.append(row)
+        unique_new_rows.append((d, row))
         if ev:
             seen.add(ev)  # track only non-empty Event #s
 
@@ -269,22 +415,33 @@ def backfill_incremental(workers: int = 12):
         print("All discovered rows were duplicates. Nothing to write.")
         return
 
-    # Sort new rows newest-first using the best available date in each row
-    today_dt = today
-    def row_dt(r: List[str]) -> date:
-        return best_row_date(r) or today_dt
-
-    unique_new_rows.sort(key=row_dt, reverse=True)
-
-    # Prepend new rows to existing (assumes existing roughly newest-first)
-    combined = unique_new_rows + existing_rows
+    # Sort new rows newest-first by the date of the PDF they came from; the
+    # sort is stable, so each PDF keeps its own row order.
+    unique_new_rows.sort(key=itemgetter(0), reverse=True)
+    new_rows = [row for _d, row in unique_new_rows]
 
-    # Write outputs
-    write_csv(combined)
-    write_json(combined)
+    # Prepend new rows to the archive (assumes existing roughly newest-first).
+    # Existing rows are copied through as-is rather than re-serialized.
+    prepend_csv(new_rows)
+    if not prepend_json(new_rows):
+        write_json(load_existing_csv())
     print(f"Wrote CSV:  {CSV_FILE.resolve()}")
     print(f"Wrote JSON: {JSON_FILE.resolve()}")
     print(f"Added {len(unique_new_rows)} new row(s). Done.")
 
+def rebuild_archive():
+    """Rewrite CSV and JSON in full from the CSV (e.g. to resync or compact the JSON)."""
+    rows = load_existing_csv()
+    write_csv(rows)
+    write_json(rows)
+    print(f"Rebuilt CSV and JSON from {len(rows)} row(s).")
+
 if __name__ == "__main__":
-    backfill_incremental(workers=12)
+    parser = argparse.ArgumentParser(description="Incremental updater for USC DPS daily PDFs.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rewrite CSV and JSON in full from the CSV instead of fetching")
+    args = parser.parse_args()
+    if args.rebuild:
+        rebuild_archive()
+    else:
+        backfill_incremental(workers=HTTP_POOL_SIZE)